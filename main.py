@@ -1,6 +1,7 @@
-from dataclasses import dataclass
-from typing import Optional, Dict, List
-from typing import Dict, List
+import sys
+from dataclasses import dataclass, field
+from itertools import combinations
+from typing import Optional, Dict, List, Tuple
 
 
 product_rank = {
@@ -24,54 +25,67 @@ deductables_rank = {
 
 core_product = {"mtpl"}
 
+# schedule multipliers indexed by rank - 1: -10% per deductible step, +7% per variant step
+deductible_multiplier = tuple(0.9 ** i for i in range(max(deductables_rank.values())))
+variant_multiplier = tuple(1.07 ** i for i in range(max(variants_rank.values())))
+
 
 def get_product_rank(product: str) -> int:
-    try:
-        return product_rank[product]
-    except KeyError as e:
-        raise KeyError(f"Unknown product key: {product!r}") from e
+    return product_rank[product]
 
 
 def get_variant_rank(variant: str) -> int:
-    try:
-        return variants_rank[variant]
-    except KeyError as e:
-        raise KeyError(f"Unknown variant key: {variant!r}") from e
+    return variants_rank[variant]
 
 
 def get_deductible_rank(deductible: int) -> int:
-    try:
-        return deductables_rank[deductible]
-    except KeyError as e:
-        raise KeyError(f"Unknown deductible key: {deductible!r}") from e
+    return deductables_rank[deductible]
 
 
-@dataclass
+@dataclass(slots=True)
 class PriceElement:
     key: str
     product: str
     variant: Optional[str] = None
     deductible: Optional[int] = None
+    is_core: bool = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.is_core = self.product in core_product
 
 
 def parse_price_key(input_key: str) -> PriceElement:
-    parts = input_key.split("_")
+    if input_key.startswith("limited_casco_"):
+        tail = input_key[len("limited_casco_"):].split("_")
+        if len(tail) == 2:
+            product = "limited_casco"
+            variant = sys.intern(tail[0])
+            deductible = int(tail[1])
+            return PriceElement(key=input_key, product=product, variant=variant, deductible=deductible)
 
-    if parts[:2] == ["limited", "casco"] and len(parts) == 4:
-        product = "limited_casco"
-        variant = parts[2]
-        deductible = int(parts[3])
-        return PriceElement(key=input_key, product=product, variant=variant, deductible=deductible)
+    parts = input_key.split("_")
 
     if len(parts) == 3:
-        product = parts[0]
-        variant = parts[1]
+        product = sys.intern(parts[0])
+        variant = sys.intern(parts[1])
         deductible = int(parts[2])
         return PriceElement(key=input_key, product=product, variant=variant, deductible=deductible)
 
     raise ValueError(f"Unrecognized key format: {input_key!r}")
 
 
+def validate_price_element(item: PriceElement) -> None:
+    # checked once when items are built so the rank lookups can stay bare
+    if item.product not in product_rank:
+        raise KeyError(f"Unknown product key: {item.product!r}")
+    if item.is_core:
+        return
+    if item.variant not in variants_rank:
+        raise KeyError(f"Unknown variant key: {item.variant!r}")
+    if item.deductible not in deductables_rank:
+        raise KeyError(f"Unknown deductible key: {item.deductible!r}")
+
+
 def build_price_items(prices: Dict[str, int]) -> List[PriceElement]:
     items: List[PriceElement] = []
 
@@ -80,236 +94,252 @@ def build_price_items(prices: Dict[str, int]) -> List[PriceElement]:
             items.append(PriceElement(key=input_key, product=input_key, variant=None, deductible=None))
         else:
             items.append(parse_price_key(input_key))
+        validate_price_element(items[-1])
 
     return items
 
 
-def detect_inconsistencies(items: List[PriceElement], prices: Dict[str, int]) -> str:
-    report: List[str] = []
+RankArrays = Tuple[List[bool], List[int], List[int], List[int], List[int]]
 
-    n = len(items)
-    for i in range(n):
-        for j in range(i + 1, n):
-            a = items[i]
-            b = items[j]
-
-            price_a = prices[a.key]
-            price_b = prices[b.key]
-
-            pa = get_product_rank(a.product)
-            pb = get_product_rank(b.product)
-
-            if pa != pb:
-                lower, higher = (a, b) if pa < pb else (b, a)
-                lower_price = price_a if lower is a else price_b
-                higher_price = price_b if higher is b else price_a
-
-                if lower.product in core_product and lower_price >= higher_price:
-                    report.append(
-                        f"PRODUCT ORDER: '{lower.key}' ({lower_price}) should be cheaper than '{higher.key}' ({higher_price})."
-                    )
-
-            if (
-                a.product != b.product
-                and a.product not in core_product
-                and b.product not in core_product
-                and a.variant == b.variant
-                and a.deductible == b.deductible
-            ):
-                pa = get_product_rank(a.product)
-                pb = get_product_rank(b.product)
-
-                lower_p, higher_p = (a, b) if pa < pb else (b, a)
-                lower_price = price_a if lower_p is a else price_b
-                higher_price = price_b if higher_p is b else price_a
-
-                if lower_price >= higher_price:
-                    report.append(
-                        f"PRODUCT ORDER (same variant+deductible): '{lower_p.key}' ({lower_price}) should be cheaper than '{higher_p.key}' ({higher_price})."
-                    )
-
-            if (
-                a.product == b.product
-                and a.product not in core_product
-                and b.product not in core_product
-                and a.deductible == b.deductible
-                
-            ):
-                va = get_variant_rank(a.variant)
-                vb = get_variant_rank(b.variant)
-
-                if va != vb:
-                    lower_v, higher_v = (a, b) if va < vb else (b, a)
-                    lower_price = price_a if lower_v is a else price_b
-                    higher_price = price_b if higher_v is b else price_a
 
-                    if lower_price >= higher_price:
-                        report.append(
-                            f"VARIANT ORDER: '{lower_v.key}' ({lower_price}) should be cheaper than '{higher_v.key}' ({higher_price})."
-                        )
-
-            if (
-                a.product == b.product
-                and a.product not in core_product
-                and b.product not in core_product
-                and a.variant == b.variant
-            ):
-                da = get_deductible_rank(a.deductible)
-                db = get_deductible_rank(b.deductible)
-
-                if da != db:
-                    lower_d, higher_d = (a, b) if da < db else (b, a)
-                    lower_price = price_a if lower_d is a else price_b
-                    higher_price = price_b if higher_d is b else price_a
-
-                    if higher_price >= lower_price:
-                        report.append(
-                            f"DEDUCTIBLE ORDER: '{higher_d.key}' ({higher_price}) should be cheaper than '{lower_d.key}' ({lower_price})."
-                        )
+def build_rank_arrays(items: List[PriceElement]) -> RankArrays:
+    # flat per-item int arrays (core items get -1 for variant/deductible);
+    # variants are mapped to small ids because compact/basic share a rank
+    is_core = [it.is_core for it in items]
+    prod_rank = [get_product_rank(it.product) for it in items]
+    var_rank = [-1 if is_core[k] else get_variant_rank(it.variant) for k, it in enumerate(items)]
+    ded_rank = [-1 if is_core[k] else get_deductible_rank(it.deductible) for k, it in enumerate(items)]
 
-    return "\n".join(report)
+    variant_ids: Dict[str, int] = {}
+    var_id = [-1 if is_core[k] else variant_ids.setdefault(it.variant, len(variant_ids)) for k, it in enumerate(items)]
 
+    return is_core, prod_rank, var_rank, ded_rank, var_id
 
 
+PRODUCT_ORDER = 0
+PRODUCT_ORDER_SAME_VARIANT_DEDUCTIBLE = 1
+VARIANT_ORDER = 2
+DEDUCTIBLE_ORDER = 3
 
+report_labels = {
+    PRODUCT_ORDER: "PRODUCT ORDER",
+    PRODUCT_ORDER_SAME_VARIANT_DEDUCTIBLE: "PRODUCT ORDER (same variant+deductible)",
+    VARIANT_ORDER: "VARIANT ORDER",
+    DEDUCTIBLE_ORDER: "DEDUCTIBLE ORDER",
+}
 
-def fix_products_inplace(
-    items: List[PriceElement],
-    prices: Dict[str, int],
-    avg_prices: Dict[str, float],
-    max_iters: int = 10,
+
+def detect_kernel(
+    is_core: List[bool],
+    prod_rank: List[int],
+    var_rank: List[int],
+    ded_rank: List[int],
+    var_id: List[int],
+    price: List[int],
+) -> List[Tuple[int, int, int, int, int]]:
+    # returns (i, j, code, cheaper, dearer) sorted by pair, where 'cheaper'
+    # is the index that should have the lower price
+    n = len(price)
+
+    # bucket indices by the axis each check compares along, so only items
+    # that can actually conflict are paired up
+    core_idx: List[int] = []
+    by_var_ded: Dict[Tuple[int, int], List[int]] = {}
+    by_prod_ded: Dict[Tuple[int, int], List[int]] = {}
+    by_prod_var: Dict[Tuple[int, int], List[int]] = {}
+    for k in range(n):
+        if is_core[k]:
+            core_idx.append(k)
+            continue
+        by_var_ded.setdefault((var_id[k], ded_rank[k]), []).append(k)
+        by_prod_ded.setdefault((prod_rank[k], ded_rank[k]), []).append(k)
+        by_prod_var.setdefault((prod_rank[k], var_id[k]), []).append(k)
+
+    found: List[Tuple[int, int, int, int, int]] = []
+
+    for c in core_idx:
+        rank_c = prod_rank[c]
+        price_c = price[c]
+        for k, (rank_k, price_k) in enumerate(zip(prod_rank, price)):
+            if rank_k == rank_c or (is_core[k] and k < c):
+                continue
+
+            if rank_c < rank_k:
+                if price_c >= price_k:
+                    found.append((min(c, k), max(c, k), PRODUCT_ORDER, c, k))
+            elif is_core[k] and price_k >= price_c:
+                found.append((min(c, k), max(c, k), PRODUCT_ORDER, k, c))
+
+    # each bucket is sorted by the rank it is checked on, so every pair from
+    # combinations() already comes as (lower rank, higher rank) and only
+    # equal ranks need skipping
+    for group in by_var_ded.values():
+        group.sort(key=prod_rank.__getitem__)
+        for lower_p, higher_p in combinations(group, 2):
+            if prod_rank[lower_p] != prod_rank[higher_p] and price[lower_p] >= price[higher_p]:
+                found.append((min(lower_p, higher_p), max(lower_p, higher_p), PRODUCT_ORDER_SAME_VARIANT_DEDUCTIBLE, lower_p, higher_p))
+
+    for group in by_prod_ded.values():
+        group.sort(key=var_rank.__getitem__)
+        for lower_v, higher_v in combinations(group, 2):
+            if var_rank[lower_v] != var_rank[higher_v] and price[lower_v] >= price[higher_v]:
+                found.append((min(lower_v, higher_v), max(lower_v, higher_v), VARIANT_ORDER, lower_v, higher_v))
+
+    for group in by_prod_var.values():
+        group.sort(key=ded_rank.__getitem__)
+        for lower_d, higher_d in combinations(group, 2):
+            if ded_rank[lower_d] != ded_rank[higher_d] and price[higher_d] >= price[lower_d]:
+                found.append((min(lower_d, higher_d), max(lower_d, higher_d), DEDUCTIBLE_ORDER, higher_d, lower_d))
+
+    found.sort()
+    return found
+
+
+def detect_inconsistencies(items: List[PriceElement], prices: Dict[str, int]) -> str:
+    is_core, prod_rank, var_rank, ded_rank, var_id = build_rank_arrays(items)
+    key = [it.key for it in items]
+    price = [prices[k] for k in key]
+
+    report: List[str] = []
+    for _, _, code, cheaper, dearer in detect_kernel(is_core, prod_rank, var_rank, ded_rank, var_id, price):
+        report.append(
+            f"{report_labels[code]}: '{key[cheaper]}' ({price[cheaper]}) should be cheaper than '{key[dearer]}' ({price[dearer]})."
+        )
+
+    return "\n".join(report)
+
+
+def fix_kernel(
+    is_core: List[bool],
+    prod_rank: List[int],
+    var_rank: List[int],
+    ded_rank: List[int],
+    var_id: List[int],
+    avg: List[Optional[float]],
+    price: List[int],
+    max_iters: int,
 ) -> None:
+    n = len(price)
+
+    # item indices per product and per non-core (product, variant) /
+    # (product, deductible) group, so a fix never rescans all items
+    members_by_product: Dict[int, List[int]] = {}
+    ded_groups: Dict[Tuple[int, int], List[int]] = {}
+    var_groups: Dict[Tuple[int, int], List[int]] = {}
+    for k in range(n):
+        members_by_product.setdefault(prod_rank[k], []).append(k)
+        if not is_core[k]:
+            ded_groups.setdefault((prod_rank[k], var_id[k]), []).append(k)
+            var_groups.setdefault((prod_rank[k], ded_rank[k]), []).append(k)
+
+    # rank-1 members of each group, whose max price is the schedule base
+    ded_group_base = {g: [k for k in members if ded_rank[k] == 1] for g, members in ded_groups.items()}
+    var_group_base = {g: [k for k in members if var_rank[k] == 1] for g, members in var_groups.items()}
+
     for _ in range(max_iters):
         changed = False
-        n = len(items)
 
         for i in range(n):
             for j in range(i + 1, n):
-                a = items[i]
-                b = items[j]
-
-                pa = get_product_rank(a.product)
-                pb = get_product_rank(b.product)
-
-                va = None if (a.product in core_product) else get_variant_rank(a.variant)  
-                vb = None if (b.product in core_product) else get_variant_rank(b.variant) 
-
-                da = None if (a.product in core_product) else get_deductible_rank(a.deductible) 
-                db = None if (b.product in core_product) else get_deductible_rank(b.deductible)  
+                pa = prod_rank[i]
+                pb = prod_rank[j]
 
                 if pa != pb:
-                    lower, higher = (a, b) if pa < pb else (b, a)
-
-                    lower_is_core = lower.product in core_product
-                    higher_is_core = higher.product in core_product
+                    lower, higher = (i, j) if pa < pb else (j, i)
 
-                    lower_price = prices[lower.key]
-                    higher_price = prices[higher.key]
+                    lower_is_core = is_core[lower]
+                    higher_is_core = is_core[higher]
 
-                    avg_low = avg_prices.get(lower.product)
-                    avg_high = avg_prices.get(higher.product)
+                    lower_price = price[lower]
+                    higher_price = price[higher]
 
-                           
-                    ratio = avg_high / avg_low
+                    ratio = avg[higher] / avg[lower]
 
                     if lower_price >= higher_price:
                         # CASE 1: non-core vs non-core + isti variant & deductible
-                        if (not lower_is_core) and (not higher_is_core) and  lower.variant == higher.variant and lower.deductible == higher.deductible :
-                            old_h = prices[higher.key]
-                            new_h = int(round(lower_price * ratio))    
-                            factor = new_h / old_h
-                            prices[higher.key] =  new_h
+                        if (not lower_is_core) and (not higher_is_core) and var_id[lower] == var_id[higher] and ded_rank[lower] == ded_rank[higher]:
+                            price[higher] = round(lower_price * ratio)
 
-                        
                         # CASE 2: lower je core, higher nije core
-                        if (lower.product in core_product) and (higher.product not in core_product):
-                           
-                            old_min = None
-                            for it in items:
-                                if it.product == higher.product:
-                                    p = prices[it.key]
-                                    old_min = p if old_min is None else min(old_min, p)
-
-                            new_min = int(round(lower_price * ratio))
-                            factor = new_min / old_min
+                        if lower_is_core and not higher_is_core:
+                            members = members_by_product[prod_rank[higher]]
+                            old_min = min(price[k] for k in members)
 
-                            for it in items:
-                                if it.product == higher.product:
-                                    new_val = int(round(prices[it.key] * factor))
-                                    prices[it.key] = new_val
+                            new_min = round(lower_price * ratio)
+                            factor = new_min / old_min
 
+                            for k in members:
+                                price[k] = round(price[k] * factor)
 
                 else:
+                    # same product: only variant/deductible ranks matter
+                    va = var_rank[i]
+                    vb = var_rank[j]
+
+                    da = ded_rank[i]
+                    db = ded_rank[j]
+
                     if(not lower_is_core and not higher_is_core
                        and  va==vb and da!=db ):
-                        
-                        lower_d, higher_d = (a, b) if da < db else (b, a)
-                        lower_price = prices[lower_d.key]
-                        higher_price = prices[higher_d.key]
-
-                        if lower_price <= higher_price:
-                            group: List[PriceElement] = []
-                            for it in items:
-                                if (
-                                    it.product == a.product
-                                    and it.product not in core_product
-                                    and it.variant == a.variant
-                                ):
-                                    group.append(it)
-
-                           #find max priority and price
-                            base = None
-                            for it in group:
-                                if get_deductible_rank(it.deductible) == 1:
-                                    p = prices[it.key]
-                                    base = p if base is None else max(base, p)
-
-                          
+
+                        lower_d, higher_d = (i, j) if da < db else (j, i)
+
+                        if price[lower_d] <= price[higher_d]:
+                            group = ded_groups[(pa, var_id[i])]
+
+                            #find max priority and price
+                            base = max((price[k] for k in ded_group_base[(pa, var_id[i])]), default=None)
+
                             # -10% for every step
-                            for it in group:
-                                r = get_deductible_rank(it.deductible)  # 1,2,3
-                                new_price = int(round(base * (0.9 ** (r - 1))))
-                                if new_price != prices[it.key]:
-                                    prices[it.key] = new_price
+                            for k in group:
+                                r = ded_rank[k]  # 1,2,3
+                                new_price = round(base * deductible_multiplier[r - 1])
+                                if new_price != price[k]:
+                                    price[k] = new_price
                                     changed = True
-                    
-                        
+
                     else:
                         if (not lower_is_core and not higher_is_core
                             and da==db and va!=vb):
-                            lower_v, higher_v = (a, b) if va < vb else (b, a)
-                            lower_price = prices[lower_v.key]
-                            higher_price = prices[higher_v.key]
-
-                            if ( lower_price >= higher_price ) :
-                                group: List[PriceElement] = []
-                                for it in items:
-                                    if (
-                                        it.product == a.product
-                                        and it.product not in core_product
-                                        and it.deductible == a.deductible
-                                    ):
-                                        group.append(it)
-
-                                base = None
-                                for it in group:
-                                    if get_variant_rank(it.variant) == 1:
-                                        p = prices[it.key]
-                                        base = p if base is None else max(base, p)
+                            lower_v, higher_v = (i, j) if va < vb else (j, i)
+
+                            if price[lower_v] >= price[higher_v]:
+                                group = var_groups[(pa, da)]
+                                base = max((price[k] for k in var_group_base[(pa, da)]), default=None)
 
                                 if base is not None:
-                                    for it in group:
-                                        r = get_variant_rank(it.variant)  # 1,2,3
-                                        new_price = int(round(base * (1.07 ** (r - 1))))
-                                        if new_price != prices[it.key]:
-                                            prices[it.key] = new_price
+                                    for k in group:
+                                        r = var_rank[k]  # 1,2,3
+                                        new_price = round(base * variant_multiplier[r - 1])
+                                        if new_price != price[k]:
+                                            price[k] = new_price
                                             changed = True
 
-
         if not changed:
             break
 
 
+def fix_products_inplace(
+    items: List[PriceElement],
+    prices: Dict[str, int],
+    avg_prices: Dict[str, float],
+    max_iters: int = 10,
+) -> None:
+    is_core, prod_rank, var_rank, ded_rank, var_id = build_rank_arrays(items)
+    avg = [avg_prices.get(it.product) for it in items]
+    key = [it.key for it in items]
+
+    # the kernel works on a positional price list; the dict is only read
+    # once here and written back in one bulk update, also when the kernel
+    # raises, so callers see the same partial fixes as before
+    price = [prices[k] for k in key]
+
+    try:
+        fix_kernel(is_core, prod_rank, var_rank, ded_rank, var_id, avg, price, max_iters)
+    finally:
+        prices.update(zip(key, price))
+
+
 def run_example() -> None:
     example_prices_to_correct = {
     "mtpl": 400,  # core ok
@@ -1,5 +1,7 @@
-from dataclasses import dataclass
-from typing import Optional, Dict, List, Callable
+import sys
+from dataclasses import dataclass, field
+from itertools import combinations
+from typing import Optional, Dict, List, Tuple
 
 
 product_rank = {
@@ -23,34 +25,33 @@ deductables_rank = {
 
 core_product = {"mtpl"}
 
+# schedule multipliers indexed by rank - 1: -10% per deductible step, +7% per variant step
+deductible_multiplier = tuple(0.9 ** i for i in range(max(deductables_rank.values())))
+variant_multiplier = tuple(1.07 ** i for i in range(max(variants_rank.values())))
+
 
 def get_product_rank(product: str) -> int:
-    try:
-        return product_rank[product]
-    except KeyError as e:
-        raise KeyError(f"Unknown product key: {product!r}") from e
+    return product_rank[product]
 
 
 def get_variant_rank(variant: str) -> int:
-    try:
-        return variants_rank[variant]
-    except KeyError as e:
-        raise KeyError(f"Unknown variant key: {variant!r}") from e
+    return variants_rank[variant]
 
 
 def get_deductible_rank(deductible: int) -> int:
-    try:
-        return deductables_rank[deductible]
-    except KeyError as e:
-        raise KeyError(f"Unknown deductible key: {deductible!r}") from e
+    return deductables_rank[deductible]
 
 
-@dataclass
+@dataclass(slots=True)
 class PriceElement:
     key: str
     product: str
     variant: Optional[str] = None
     deductible: Optional[int] = None
+    is_core: bool = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.is_core = is_core_product(self.product)
 
 
 def is_core_product(product: str) -> bool:
@@ -58,23 +59,37 @@ def is_core_product(product: str) -> bool:
 
 
 def parse_price_key(input_key: str) -> PriceElement:
-    parts = input_key.split("_")
+    if input_key.startswith("limited_casco_"):
+        tail = input_key[len("limited_casco_"):].split("_")
+        if len(tail) == 2:
+            product = "limited_casco"
+            variant = sys.intern(tail[0])
+            deductible = int(tail[1])
+            return PriceElement(key=input_key, product=product, variant=variant, deductible=deductible)
 
-    if parts[:2] == ["limited", "casco"] and len(parts) == 4:
-        product = "limited_casco"
-        variant = parts[2]
-        deductible = int(parts[3])
-        return PriceElement(key=input_key, product=product, variant=variant, deductible=deductible)
+    parts = input_key.split("_")
 
     if len(parts) == 3:
-        product = parts[0]
-        variant = parts[1]
+        product = sys.intern(parts[0])
+        variant = sys.intern(parts[1])
         deductible = int(parts[2])
         return PriceElement(key=input_key, product=product, variant=variant, deductible=deductible)
 
     raise ValueError(f"Unrecognized key format: {input_key!r}")
 
 
+def validate_price_element(item: PriceElement) -> None:
+    # checked once when items are built so the rank lookups can stay bare
+    if item.product not in product_rank:
+        raise KeyError(f"Unknown product key: {item.product!r}")
+    if item.is_core:
+        return
+    if item.variant not in variants_rank:
+        raise KeyError(f"Unknown variant key: {item.variant!r}")
+    if item.deductible not in deductables_rank:
+        raise KeyError(f"Unknown deductible key: {item.deductible!r}")
+
+
 def build_price_items(prices: Dict[str, int]) -> List[PriceElement]:
     items: List[PriceElement] = []
     for input_key in prices.keys():
@@ -82,241 +97,314 @@ def build_price_items(prices: Dict[str, int]) -> List[PriceElement]:
             items.append(PriceElement(key=input_key, product=input_key, variant=None, deductible=None))
         else:
             items.append(parse_price_key(input_key))
+        validate_price_element(items[-1])
     return items
 
 
-def group_items(items: List[PriceElement], predicate: Callable[[PriceElement], bool]) -> List[PriceElement]:
-    return [it for it in items if predicate(it)]
+def max_price_in_group(group: List[int], price: List[int]) -> Optional[int]:
+    return max((price[k] for k in group), default=None)
+
+
+def min_price_in_group(group: List[int], price: List[int]) -> Optional[int]:
+    return min((price[k] for k in group), default=None)
+
+
+RankArrays = Tuple[List[bool], List[int], List[int], List[int], List[int]]
+
 
+def build_rank_arrays(items: List[PriceElement]) -> RankArrays:
+    # flat per-item int arrays (core items get -1 for variant/deductible);
+    # variants are mapped to small ids because compact/basic share a rank
+    is_core = [it.is_core for it in items]
+    prod_rank = [get_product_rank(it.product) for it in items]
+    var_rank = [-1 if is_core[k] else get_variant_rank(it.variant) for k, it in enumerate(items)]
+    ded_rank = [-1 if is_core[k] else get_deductible_rank(it.deductible) for k, it in enumerate(items)]
 
-def max_price_in_group(items: List[PriceElement], prices: Dict[str, int], predicate: Callable[[PriceElement], bool]) -> Optional[int]:
-    mx = None
-    for it in items:
-        if predicate(it):
-            p = prices[it.key]
-            mx = p if mx is None else max(mx, p)
-    return mx
+    variant_ids: Dict[str, int] = {}
+    var_id = [-1 if is_core[k] else variant_ids.setdefault(it.variant, len(variant_ids)) for k, it in enumerate(items)]
 
+    return is_core, prod_rank, var_rank, ded_rank, var_id
 
-def min_price_in_group(items: List[PriceElement], prices: Dict[str, int], predicate: Callable[[PriceElement], bool]) -> Optional[int]:
-    mn = None
-    for it in items:
-        if predicate(it):
-            p = prices[it.key]
-            mn = p if mn is None else min(mn, p)
-    return mn
+
+IndexBuckets = Tuple[Dict[int, List[int]], Dict[Tuple[int, int], List[int]], Dict[Tuple[int, int], List[int]]]
+
+
+def build_index_buckets(
+    is_core: List[bool],
+    prod_rank: List[int],
+    var_id: List[int],
+    ded_rank: List[int],
+) -> IndexBuckets:
+    # item indices per product, per non-core (product, variant) and per
+    # non-core (product, deductible), in ascending order
+    by_product: Dict[int, List[int]] = {}
+    by_prod_var: Dict[Tuple[int, int], List[int]] = {}
+    by_prod_ded: Dict[Tuple[int, int], List[int]] = {}
+    for k in range(len(prod_rank)):
+        by_product.setdefault(prod_rank[k], []).append(k)
+        if is_core[k]:
+            continue
+        by_prod_var.setdefault((prod_rank[k], var_id[k]), []).append(k)
+        by_prod_ded.setdefault((prod_rank[k], ded_rank[k]), []).append(k)
+
+    return by_product, by_prod_var, by_prod_ded
+
+
+PRODUCT_ORDER = 0
+PRODUCT_ORDER_SAME_VARIANT_DEDUCTIBLE = 1
+VARIANT_ORDER = 2
+DEDUCTIBLE_ORDER = 3
+
+report_labels = {
+    PRODUCT_ORDER: "PRODUCT ORDER",
+    PRODUCT_ORDER_SAME_VARIANT_DEDUCTIBLE: "PRODUCT ORDER (same variant+deductible)",
+    VARIANT_ORDER: "VARIANT ORDER",
+    DEDUCTIBLE_ORDER: "DEDUCTIBLE ORDER",
+}
+
+
+def detect_kernel(
+    is_core: List[bool],
+    prod_rank: List[int],
+    var_rank: List[int],
+    ded_rank: List[int],
+    var_id: List[int],
+    price: List[int],
+) -> List[Tuple[int, int, int, int, int]]:
+    # returns (i, j, code, cheaper, dearer) sorted by pair, where 'cheaper'
+    # is the index that should have the lower price
+    n = len(price)
+
+    # bucket indices by the axis each check compares along, so only items
+    # that can actually conflict are paired up
+    core_idx: List[int] = []
+    by_var_ded: Dict[Tuple[int, int], List[int]] = {}
+    by_prod_ded: Dict[Tuple[int, int], List[int]] = {}
+    by_prod_var: Dict[Tuple[int, int], List[int]] = {}
+    for k in range(n):
+        if is_core[k]:
+            core_idx.append(k)
+            continue
+        by_var_ded.setdefault((var_id[k], ded_rank[k]), []).append(k)
+        by_prod_ded.setdefault((prod_rank[k], ded_rank[k]), []).append(k)
+        by_prod_var.setdefault((prod_rank[k], var_id[k]), []).append(k)
+
+    found: List[Tuple[int, int, int, int, int]] = []
+
+    for c in core_idx:
+        rank_c = prod_rank[c]
+        price_c = price[c]
+        for k, (rank_k, price_k) in enumerate(zip(prod_rank, price)):
+            if rank_k == rank_c or (is_core[k] and k < c):
+                continue
+
+            if rank_c < rank_k:
+                if price_c >= price_k:
+                    found.append((min(c, k), max(c, k), PRODUCT_ORDER, c, k))
+            elif is_core[k] and price_k >= price_c:
+                found.append((min(c, k), max(c, k), PRODUCT_ORDER, k, c))
+
+    # each bucket is sorted by the rank it is checked on, so every pair from
+    # combinations() already comes as (lower rank, higher rank) and only
+    # equal ranks need skipping
+    for group in by_var_ded.values():
+        group.sort(key=prod_rank.__getitem__)
+        for lower_p, higher_p in combinations(group, 2):
+            if prod_rank[lower_p] != prod_rank[higher_p] and price[lower_p] >= price[higher_p]:
+                found.append((min(lower_p, higher_p), max(lower_p, higher_p), PRODUCT_ORDER_SAME_VARIANT_DEDUCTIBLE, lower_p, higher_p))
+
+    for group in by_prod_ded.values():
+        group.sort(key=var_rank.__getitem__)
+        for lower_v, higher_v in combinations(group, 2):
+            if var_rank[lower_v] != var_rank[higher_v] and price[lower_v] >= price[higher_v]:
+                found.append((min(lower_v, higher_v), max(lower_v, higher_v), VARIANT_ORDER, lower_v, higher_v))
+
+    for group in by_prod_var.values():
+        group.sort(key=ded_rank.__getitem__)
+        for lower_d, higher_d in combinations(group, 2):
+            if ded_rank[lower_d] != ded_rank[higher_d] and price[higher_d] >= price[lower_d]:
+                found.append((min(lower_d, higher_d), max(lower_d, higher_d), DEDUCTIBLE_ORDER, higher_d, lower_d))
+
+    found.sort()
+    return found
 
 
 def detect_inconsistencies(items: List[PriceElement], prices: Dict[str, int]) -> str:
-    report: List[str] = []
-    n = len(items)
-
-    for i in range(n):
-        for j in range(i + 1, n):
-            a = items[i]
-            b = items[j]
-
-            price_a = prices[a.key]
-            price_b = prices[b.key]
-
-            pa = get_product_rank(a.product)
-            pb = get_product_rank(b.product)
-
-            if pa != pb:
-                lower, higher = (a, b) if pa < pb else (b, a)
-                lower_price = price_a if lower is a else price_b
-                higher_price = price_b if higher is b else price_a
-
-                if lower.product in core_product and lower_price >= higher_price:
-                    report.append(
-                        f"PRODUCT ORDER: '{lower.key}' ({lower_price}) should be cheaper than '{higher.key}' ({higher_price})."
-                    )
-
-            if (
-                a.product != b.product
-                and a.product not in core_product
-                and b.product not in core_product
-                and a.variant == b.variant
-                and a.deductible == b.deductible
-            ):
-                pa2 = get_product_rank(a.product)
-                pb2 = get_product_rank(b.product)
-
-                lower_p, higher_p = (a, b) if pa2 < pb2 else (b, a)
-                lower_price = price_a if lower_p is a else price_b
-                higher_price = price_b if higher_p is b else price_a
-
-                if lower_price >= higher_price:
-                    report.append(
-                        f"PRODUCT ORDER (same variant+deductible): '{lower_p.key}' ({lower_price}) should be cheaper than '{higher_p.key}' ({higher_price})."
-                    )
-
-            if (
-                a.product == b.product
-                and a.product not in core_product
-                and b.product not in core_product
-                and a.deductible == b.deductible
-            ):
-                va = get_variant_rank(a.variant)
-                vb = get_variant_rank(b.variant)
-
-                if va != vb:
-                    lower_v, higher_v = (a, b) if va < vb else (b, a)
-                    lower_price = price_a if lower_v is a else price_b
-                    higher_price = price_b if higher_v is b else price_a
+    is_core, prod_rank, var_rank, ded_rank, var_id = build_rank_arrays(items)
+    key = [it.key for it in items]
+    price = [prices[k] for k in key]
 
-                    if lower_price >= higher_price:
-                        report.append(
-                            f"VARIANT ORDER: '{lower_v.key}' ({lower_price}) should be cheaper than '{higher_v.key}' ({higher_price})."
-                        )
-
-            if (
-                a.product == b.product
-                and a.product not in core_product
-                and b.product not in core_product
-                and a.variant == b.variant
-            ):
-                da = get_deductible_rank(a.deductible)
-                db = get_deductible_rank(b.deductible)
-
-                if da != db:
-                    lower_d, higher_d = (a, b) if da < db else (b, a)
-                    lower_price = price_a if lower_d is a else price_b
-                    higher_price = price_b if higher_d is b else price_a
-
-                    if higher_price >= lower_price:
-                        report.append(
-                            f"DEDUCTIBLE ORDER: '{higher_d.key}' ({higher_price}) should be cheaper than '{lower_d.key}' ({lower_price})."
-                        )
+    report: List[str] = []
+    for _, _, code, cheaper, dearer in detect_kernel(is_core, prod_rank, var_rank, ded_rank, var_id, price):
+        report.append(
+            f"{report_labels[code]}: '{key[cheaper]}' ({price[cheaper]}) should be cheaper than '{key[dearer]}' ({price[dearer]})."
+        )
 
     return "\n".join(report)
 
 
-def scale_product(items: List[PriceElement], prices: Dict[str, int], product: str, factor: float) -> bool:
+def scale_product(members: List[int], price: List[int], factor: float) -> bool:
     changed = False
-    for it in items:
-        if it.product == product:
-            new_val = int(round(prices[it.key] * factor))
-            if new_val != prices[it.key]:
-                prices[it.key] = new_val
-                changed = True
+    for k in members:
+        new_val = round(price[k] * factor)
+        if new_val != price[k]:
+            price[k] = new_val
+            changed = True
     return changed
 
 
-def apply_deductible_schedule(group: List[PriceElement], prices: Dict[str, int], base: int) -> bool:
-    changed = False
-    for it in group:
-        r = get_deductible_rank(it.deductible)
-        new_price = int(round(base * (0.9 ** (r - 1))))
-        if new_price != prices[it.key]:
-            prices[it.key] = new_price
-            changed = True
-    return changed
+Schedule = List[Tuple[int, float]]
+
+
+def build_schedule(group: List[int], ranks: List[int], multiplier: Tuple[float, ...]) -> Schedule:
+    return [(k, multiplier[ranks[k] - 1]) for k in group]
 
 
-def apply_variant_schedule(group: List[PriceElement], prices: Dict[str, int], base: int) -> bool:
+def apply_schedule(schedule: Schedule, price: List[int], base: int) -> bool:
     changed = False
-    for it in group:
-        r = get_variant_rank(it.variant)
-        new_price = int(round(base * (1.07 ** (r - 1))))
-        if new_price != prices[it.key]:
-            prices[it.key] = new_price
+    for k, m in schedule:
+        new_price = round(base * m)
+        if new_price != price[k]:
+            price[k] = new_price
             changed = True
     return changed
 
 
-def fix_products_inplace(
-    items: List[PriceElement],
-    prices: Dict[str, int],
-    avg_prices: Dict[str, float],
-    max_iters: int = 10,
+def fix_kernel(
+    is_core: List[bool],
+    prod_rank: List[int],
+    var_rank: List[int],
+    ded_rank: List[int],
+    var_id: List[int],
+    avg: List[Optional[float]],
+    price: List[int],
+    max_iters: int,
 ) -> None:
+    n = len(price)
+
+    by_product, by_prod_var, by_prod_ded = build_index_buckets(is_core, prod_rank, var_id, ded_rank)
+
+    # rank-1 members of each group are the base of its price schedule
+    ded_base_members = {g: [k for k in members if ded_rank[k] == 1] for g, members in by_prod_var.items()}
+    var_base_members = {g: [k for k in members if var_rank[k] == 1] for g, members in by_prod_ded.items()}
+
+    # the schema fixes every member's step in its group's schedule, so the
+    # multipliers are resolved once instead of per rewrite
+    ded_schedules = {g: build_schedule(members, ded_rank, deductible_multiplier) for g, members in by_prod_var.items()}
+    var_schedules = {g: build_schedule(members, var_rank, variant_multiplier) for g, members in by_prod_ded.items()}
+
+    # products whose prices moved in the previous pass / so far in this one;
+    # a pair of untouched products evaluates exactly as it did last time
+    dirty = set(by_product)
+
     for _ in range(max_iters):
         changed = False
-        n = len(items)
+        prev_dirty, dirty = dirty, set()
 
         for i in range(n):
             for j in range(i + 1, n):
-                a = items[i]
-                b = items[j]
-
-                pa = get_product_rank(a.product)
-                pb = get_product_rank(b.product)
+                pa = prod_rank[i]
+                pb = prod_rank[j]
 
-                a_is_core = is_core_product(a.product)
-                b_is_core = is_core_product(b.product)
-
-                va = None if a_is_core else get_variant_rank(a.variant)
-                vb = None if b_is_core else get_variant_rank(b.variant)
-                da = None if a_is_core else get_deductible_rank(a.deductible)
-                db = None if b_is_core else get_deductible_rank(b.deductible)
-
-                price_a = prices[a.key]
-                price_b = prices[b.key]
+                if pa not in prev_dirty and pb not in prev_dirty and pa not in dirty and pb not in dirty:
+                    continue
 
                 if pa != pb:
-                    lower, higher = (a, b) if pa < pb else (b, a)
-                    lower_price = prices[lower.key]
-                    higher_price = prices[higher.key]
+                    lower, higher = (i, j) if pa < pb else (j, i)
+                    lower_price = price[lower]
+                    higher_price = price[higher]
 
-                    lower_is_core = is_core_product(lower.product)
-                    higher_is_core = is_core_product(higher.product)
+                    lower_is_core = is_core[lower]
+                    higher_is_core = is_core[higher]
 
-                    avg_low = avg_prices.get(lower.product)
-                    avg_high = avg_prices.get(higher.product)
+                    avg_low = avg[lower]
+                    avg_high = avg[higher]
                     if avg_low is None or avg_high is None or avg_low == 0:
                         continue
                     ratio = avg_high / avg_low
 
                     if lower_price >= higher_price:
-                        if (not lower_is_core) and (not higher_is_core) and (lower.variant == higher.variant) and (lower.deductible == higher.deductible):
-                            old_h = prices[higher.key]
-                            new_h = int(round(lower_price * ratio))
+                        if (not lower_is_core) and (not higher_is_core) and (var_id[lower] == var_id[higher]) and (ded_rank[lower] == ded_rank[higher]):
+                            old_h = price[higher]
+                            new_h = round(lower_price * ratio)
                             if old_h != 0:
                                 factor = new_h / old_h
-                                prices[higher.key] = new_h
-                                changed |= scale_product(items, prices, higher.product, factor)
+                                price[higher] = new_h
+                                if new_h != old_h:
+                                    dirty.add(prod_rank[higher])
+                                if scale_product(by_product[prod_rank[higher]], price, factor):
+                                    changed = True
+                                    dirty.add(prod_rank[higher])
 
                         if lower_is_core and (not higher_is_core):
-                            old_min = min_price_in_group(items, prices, lambda it: it.product == higher.product)
+                            members = by_product[prod_rank[higher]]
+                            old_min = min_price_in_group(members, price)
                             if old_min is not None and old_min != 0:
-                                new_min = int(round(lower_price * ratio))
+                                new_min = round(lower_price * ratio)
                                 factor = new_min / old_min
-                                changed |= scale_product(items, prices, higher.product, factor)
-
-                else:
-                    if (not a_is_core) and (not b_is_core) and (va == vb) and (da != db):
-                        lower_d, higher_d = (a, b) if da < db else (b, a)
-                        lower_price = prices[lower_d.key]
-                        higher_price = prices[higher_d.key]
+                                if scale_product(members, price, factor):
+                                    changed = True
+                                    dirty.add(prod_rank[higher])
+
+                elif not is_core[i]:
+                    # same non-core product (so j is non-core too): only
+                    # variant/deductible ranks matter
+                    va = var_rank[i]
+                    vb = var_rank[j]
+                    da = ded_rank[i]
+                    db = ded_rank[j]
+
+                    if (va == vb) and (da != db):
+                        lower_d, higher_d = (i, j) if da < db else (j, i)
+                        lower_price = price[lower_d]
+                        higher_price = price[higher_d]
 
                         if lower_price <= higher_price:
-                            group = group_items(
-                                items,
-                                lambda it: (it.product == a.product and (not is_core_product(it.product)) and it.variant == a.variant),
-                            )
-                            base = max_price_in_group(group, prices, lambda it: get_deductible_rank(it.deductible) == 1)
+                            group_key = (pa, var_id[i])
+                            base = max_price_in_group(ded_base_members[group_key], price)
                             if base is not None:
-                                changed |= apply_deductible_schedule(group, prices, base)
+                                if apply_schedule(ded_schedules[group_key], price, base):
+                                    changed = True
+                                    dirty.add(pa)
 
-                    if (not a_is_core) and (not b_is_core) and (da == db) and (va != vb):
-                        lower_v, higher_v = (a, b) if va < vb else (b, a)
-                        lower_price = prices[lower_v.key]
-                        higher_price = prices[higher_v.key]
+                    if (da == db) and (va != vb):
+                        lower_v, higher_v = (i, j) if va < vb else (j, i)
+                        lower_price = price[lower_v]
+                        higher_price = price[higher_v]
 
                         if lower_price >= higher_price:
-                            group = group_items(
-                                items,
-                                lambda it: (it.product == a.product and (not is_core_product(it.product)) and it.deductible == a.deductible),
-                            )
-                            base = max_price_in_group(group, prices, lambda it: get_variant_rank(it.variant) == 1)
+                            group_key = (pa, da)
+                            base = max_price_in_group(var_base_members[group_key], price)
                             if base is not None:
-                                changed |= apply_variant_schedule(group, prices, base)
+                                if apply_schedule(var_schedules[group_key], price, base):
+                                    changed = True
+                                    dirty.add(pa)
 
         if not changed:
             break
 
 
+def fix_products_inplace(
+    items: List[PriceElement],
+    prices: Dict[str, int],
+    avg_prices: Dict[str, float],
+    max_iters: int = 10,
+) -> None:
+    is_core, prod_rank, var_rank, ded_rank, var_id = build_rank_arrays(items)
+    avg = [avg_prices.get(it.product) for it in items]
+    key = [it.key for it in items]
+
+    # the kernel works on a positional price list; the dict is only read
+    # once here and written back in one bulk update, also when the kernel
+    # raises, so callers see the same partial fixes as before
+    price = [prices[k] for k in key]
+
+    try:
+        fix_kernel(is_core, prod_rank, var_rank, ded_rank, var_id, avg, price, max_iters)
+    finally:
+        prices.update(zip(key, price))
+
+
 def print_prices(prices: Dict[str, int]) -> None:
     for k in sorted(prices.keys()):
         print(f"{k}: {prices[k]}")